@@ -1,9 +1,14 @@
-from crewai.flow.flow import Flow, listen, router, start
+from crewai.flow.flow import Flow, listen, start
 from crewai import LLM
-from pydantic import BaseModel, Field, ValidationError
+from crewai.events import crewai_event_bus, LLMStreamChunkEvent
+from pydantic import BaseModel, ConfigDict, PrivateAttr
 from dotenv import load_dotenv
-from typing import Literal, List, Dict
-import os, json
+from google.genai import types as genai_types
+from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from aioconsole import ainput
+import asyncio, atexit, httpx, os, re
 
 # Load environment variables - Same as langgraph
 load_dotenv()
@@ -11,160 +16,460 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 GEMINI_MODEL = os.environ.get("MODEL")
 os.environ["CREWAI_DISABLE_TELEMETRY"] = "True" # Disable telemetry error message in terminal
 
-# Define LLM model - Used CrewAI's `LLM` class
-gemini_llm = LLM(
-    model=GEMINI_MODEL,
+# One pooled HTTP/2 client for every Gemini call in the process - Keep-alive connections are reused across turns
+# instead of paying a new TCP + TLS handshake per request. CrewAI's Gemini provider hands it to the google-genai client.
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+    timeout=60
+)
+atexit.register(http_client.close)
+GEMINI_CLIENT_PARAMS = {"http_options": genai_types.HttpOptions(httpx_client=http_client)}
+
+# With `stream=True` CrewAI emits a LLMStreamChunkEvent for each chunk, print them as they arrive.
+# Chunk handlers run in order on the calling thread, `crewai_event_bus.flush()` after the call waits for any still pending
+# The count lets LLMRouter tell whether a failed streamed call already put part of a reply on screen
+printed_chunks = {"count": 0}
+
+@crewai_event_bus.on(LLMStreamChunkEvent)
+def print_stream_chunk(source, event):
+    printed_chunks["count"] += 1
+    print(event.chunk, end="", flush=True)
+
+# Optional self-hosted OpenAI-compatible backend (e.g. vLLM) - Unset by default, so the script talks to Gemini only.
+# A continuous-batching server batches concurrent sessions at iteration level instead of serving one call at a time.
+# Start it with `--enable-prefix-caching --max-num-seqs 128 --max-num-batched-tokens 8192` so the shared persona
+# system prompts are served from its prefix cache, e.g. VLLM_API_BASE=http://vllm:8000/v1
+VLLM_API_BASE = os.environ.get("VLLM_API_BASE")
+VLLM_MODEL = os.environ.get("VLLM_MODEL", "llama-3-8b-instruct")
+VLLM_API_KEY = os.environ.get("VLLM_API_KEY", "sk-local")
+# Short timeout and no client retries, so a backend that hangs fails over to Gemini quickly
+VLLM_TIMEOUT = float(os.environ.get("VLLM_TIMEOUT", "10"))
+
+class LLMRouter:
+    # Thin wrapper with the same `.call()` as CrewAI's `LLM` - Tries the batching backend first, Gemini if it fails
+    # Shared by every handle - After the first failure the backend is skipped for the rest of the session,
+    # so a server that is down costs one timeout instead of one per call (reply, summary and warm-up alike)
+    primary_down = False
+
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+
+    def call(self, messages):
+        if LLMRouter.primary_down:
+            return self.fallback.call(messages)
+
+        chunks_before = printed_chunks["count"]
+        try:
+            return self.primary.call(messages)
+        except Exception:
+            LLMRouter.primary_down = True
+            crewai_event_bus.flush()
+            if printed_chunks["count"] > chunks_before:
+                # Part of the reply is already on screen, mark the restart so the Gemini reply is not read as its continuation
+                print("\n[backend failed, restarting the reply on Gemini]\nAssistant: ", end="", flush=True)
+            return self.fallback.call(messages)
+
+def make_llm(max_output_tokens=None, **kwargs):
+    # Every handle below is built here, so the backend choice is made once for all of them
+    # Decode cap - CrewAI's native Gemini provider only sends `max_output_tokens` (a `max_tokens` is stored but never sent),
+    # the OpenAI-compatible provider only knows `max_tokens`, so each handle gets the name its provider reads
+    gemini_llm = LLM(
+        model=GEMINI_MODEL,
+        client_params=GEMINI_CLIENT_PARAMS,
+        max_output_tokens=max_output_tokens,
+        **kwargs
+    )
+    if not VLLM_API_BASE:
+        return gemini_llm
+    # `openai/` prefix plus a custom api_base goes to CrewAI's OpenAI-compatible provider
+    vllm_llm = LLM(
+        model=f"openai/{VLLM_MODEL}",
+        api_base=VLLM_API_BASE,
+        api_key=VLLM_API_KEY,
+        timeout=VLLM_TIMEOUT,
+        max_retries=0,
+        max_tokens=max_output_tokens,
+        **kwargs
+    )
+    return LLMRouter(vllm_llm, gemini_llm)
+
+# Define LLM models - Used CrewAI's `LLM` class via make_llm(), one handle per persona so each gets its own decode budget
+# Chat replies are short, tight `max_output_tokens` and stop sequences end runaway generations early
+therapist_llm = make_llm(
+    temperature=0.3,
+    max_output_tokens=512,
+    stream=True # Emit the reply chunk by chunk instead of waiting for the full completion
+)
+
+logical_llm = make_llm(
     temperature=0,
-    max_tokens=4096
+    max_output_tokens=384,
+    stop=["\n\nUser:", "\n\n---"],
+    stream=True
 )
 
+PERSONA_LLMS = {"emotional": therapist_llm, "logical": logical_llm}
+
+# Built once at import and reused every turn - Plain text output, the persona is read from the leading tag
+# It may answer in either persona, so it gets the larger of the two budgets
+routed_llm = make_llm(
+    temperature=0,
+    max_output_tokens=512,
+    stop=["\n\nUser:"]
+)
+
+# Non-streaming LLM for the rolling history summary, so the summary is not printed to the terminal
+summary_llm = make_llm(
+    temperature=0,
+    max_output_tokens=256
+)
+
+# Non-streaming LLM that only keeps the provider's prefix cache warm between turns, one output token per request.
+# On Gemini 2.5 the thinking tokens count against `max_output_tokens` too, so the cap also bounds them
+warm_llm = make_llm(
+    temperature=0,
+    max_output_tokens=1
+)
+
+# Gemini only caches prefixes implicitly from 1024 input tokens on (more on the Pro models), a shorter prefix is not worth warming.
+# Estimated at ~4 characters per token, which is close enough for a skip threshold
+IMPLICIT_CACHE_MIN_TOKENS = 1024
+
+# Rolling history window - Once the history grows past SUMMARY_THRESHOLD messages,
+# everything but the last MAX_HISTORY_TURNS messages is folded into a short summary
+MAX_HISTORY_TURNS = 8
+SUMMARY_THRESHOLD = 16
+
+# One background worker for the summary call, so it overlaps with the reply instead of delaying it
+summary_executor = ThreadPoolExecutor(max_workers=1)
+
+# System prompts - Module-level constants so every turn sends a byte-identical prefix, which is what provider-side prefix caching matches on
+THERAPIST_SYS = """You are a compassionate therapist. Focus on the emotional aspects of the user's message.
+Show empathy, validate their feelings, and help them process their emotions.
+Ask thoughtful questions to help them explore their feelings more deeply.
+Avoid giving logical solutions unless explicitly asked."""
+
+LOGICAL_SYS = """You are a purely logical assistant. Focus only on facts and information.
+Provide clear, concise answers based on logic and evidence.
+Do not address emotions or provide emotional support.
+Be direct and straightforward in your responses."""
+
+# Persona table - message_type -> system prompt, so both personas share one response path
+PERSONAS = {"emotional": THERAPIST_SYS, "logical": LOGICAL_SYS}
+
+ROUTED_SYS = """First decide silently whether the user's message is emotional or logical, then respond in that persona.
+- 'emotional': if it asks for emotional support, therapy, deals with feelings, or personal problems.
+  Respond as a compassionate therapist. Show empathy, validate their feelings, and help them process their emotions.
+  Ask thoughtful questions to help them explore their feelings more deeply.
+  Avoid giving logical solutions unless explicitly asked.
+- 'logical': if it asks for facts, information, logical analysis, or practical solutions.
+  Respond as a purely logical assistant. Provide clear, concise answers based on logic and evidence.
+  Do not address emotions or provide emotional support. Be direct and straightforward.
+Begin your response with a single character on its own line: E for emotional or L for logical. Then write the reply."""
+
+# Precompiled keyword scorers for the local classifier - Clear-cut messages are classified without an LLM call
+EMO = re.compile(r"\b(feel|sad|anxious|lonely|depress|angry|hurt|cry|grief|stressed|overwhelm|scared|love|hate)\w*\b", re.I)
+LOG = re.compile(r"\b(what is|what are|how do|how does|how to|why does|calculate|define|explain|compare|\d+)\b", re.I)
+
+def classify_message(text):
+    # Returns "emotional" or "logical" when the keyword scores clearly disagree, None when the LLM should decide
+    emo_hits = len(EMO.findall(text))
+    log_hits = len(LOG.findall(text))
+    if abs(emo_hits - log_hits) >= 2 or (min(emo_hits, log_hits) == 0 and max(emo_hits, log_hits) >= 1):
+        return "emotional" if emo_hits > log_hits else "logical"
+    return None
+
+# Persona tags for the routed call - The model spends one leading character on the classification instead of a JSON object
+PERSONA_TAGS = {"E": "emotional", "L": "logical"}
+LEADING_BLANK_LINES = re.compile(r"^(?:[ \t]*\n)+")
+
+def parse_routed_reply(text):
+    # Split "E\n<reply>" / "L\n<reply>" into (message_type, reply), message_type is None when the model left out the tag
+    # or wrote nothing after it (e.g. a stop or length cutoff)
+    text = text.lstrip()
+    tag = text[:1].upper()
+    rest = text[1:].lstrip(" ")
+    # Only a tag followed by a newline or ':' counts, so replies such as "E.g., ..." are not mistaken for a tag.
+    # The separator and any blank lines after it are removed, the reply's own leading characters (e.g. a "- " bullet) are kept
+    if tag in PERSONA_TAGS and (not rest or rest[0] in "\n:"):
+        reply = LEADING_BLANK_LINES.sub("", rest.removeprefix(":").lstrip(" "))
+        # A bare tag is no verdict, so it is never cached
+        return (PERSONA_TAGS[tag], reply) if reply.strip() else (None, "")
+    return None, text
+
+# Verdicts of earlier routed calls by normalized message - Repeats such as "thanks" or "what?" skip the routed prompt
+# The cache lives for the process, which only ever talks to the GEMINI_MODEL read at import
+VERDICT_CACHE_SIZE = 1024
+verdict_cache = OrderedDict()
+
+def normalize_message(text):
+    return " ".join(text.lower().split())
+
+def cached_verdict(text):
+    # Least recently used entries are evicted first, so a hit moves the entry to the end
+    key = normalize_message(text)
+    if key not in verdict_cache:
+        return None
+    verdict_cache.move_to_end(key)
+    return verdict_cache[key]
+
+def remember_verdict(text, message_type):
+    key = normalize_message(text)
+    verdict_cache[key] = message_type
+    verdict_cache.move_to_end(key)
+    if len(verdict_cache) > VERDICT_CACHE_SIZE:
+        verdict_cache.popitem(last=False)
+
+# Optional local classifier - A distilled 2-class transformer exported to ONNX and quantized to int8, a few ms on CPU
+# It is only loaded when CLASSIFIER_ONNX / CLASSIFIER_TOKENIZER point at existing files and onnxruntime + tokenizers are installed,
+# otherwise undecided messages go to the routed LLM call as before. The model file is not shipped with this repo.
+# Expected model: inputs `input_ids` and `attention_mask` (int64), output logits of shape (1, 2) with index 0 = emotional, 1 = logical
+# Both paths default to files next to this script, not to the current working directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CLASSIFIER_ONNX = os.environ.get("CLASSIFIER_ONNX", os.path.join(SCRIPT_DIR, "classifier_int8.onnx"))
+CLASSIFIER_TOKENIZER = os.environ.get("CLASSIFIER_TOKENIZER", os.path.join(SCRIPT_DIR, "classifier_tokenizer.json"))
+# Debug/eval switch - Skips every local classifier so each message goes through the routed LLM call
+FORCE_LLM_ROUTING = os.environ.get("FORCE_LLM_ROUTING", "").lower() in ("1", "true")
+
+classifier_session = None
+classifier_tokenizer = None
+if not FORCE_LLM_ROUTING and os.path.exists(CLASSIFIER_ONNX) and os.path.exists(CLASSIFIER_TOKENIZER):
+    try:
+        import numpy as np
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+        # Loaded once at import, every turn reuses the same session
+        classifier_session = ort.InferenceSession(CLASSIFIER_ONNX, providers=["CPUExecutionProvider"])
+        classifier_tokenizer = Tokenizer.from_file(CLASSIFIER_TOKENIZER)
+        classifier_tokenizer.enable_truncation(max_length=128)
+    except Exception as e:
+        # Missing packages or a corrupt / incompatible model file must not stop the chatbot from starting
+        print(f"(local classifier disabled: {e})")
+        classifier_session = None
+        classifier_tokenizer = None
+
+def onnx_classify(text):
+    # Returns "emotional" or "logical" from the local model, None when it is not loaded
+    if classifier_session is None:
+        return None
+    encoding = classifier_tokenizer.encode(text)
+    ids = np.array([encoding.ids], dtype=np.int64)
+    mask = np.array([encoding.attention_mask], dtype=np.int64)
+    try:
+        logits = classifier_session.run(None, {"input_ids": ids, "attention_mask": mask})[0]
+    except Exception:
+        # A model whose inputs or outputs do not match leaves the message to the routed LLM call
+        return None
+    return "emotional" if logits[0, 0] > logits[0, 1] else "logical"
+
 # Define the state model - Used Pydantic `BaseModel` for structured state instead of TypedDict
-# Langgraph's add_message automatically append conversation history. 
+# Langgraph's add_messages reducer can automatically append conversation history. 
 # CrewAI can even maintain conversation history between sessions by @persist decorator
 # In this example, to maintain coversation history within session, need to do it manually
 class MessageState(BaseModel):
+    # Internal value holder, not a validation boundary - Assignments such as `self.state.response = ...` are stored without
+    # re-running the field validators. CrewAI's Flow only accepts a BaseModel or dict state, so a slots dataclass is not an option
+    model_config = ConfigDict(validate_assignment=False)
+
     user_message: str = ""
     message_type: str = ""
     response: str = ""
-    conversation_history: List[Dict[str, str]] = [] # Save conversation history
-
-# Define the classifier model - Same as langgraph
-class MessageClassifier(BaseModel):
-    message_type: Literal["emotional", "logical"] = Field(
-        ...,
-        description="Classify if the message requires an emotional (therapist) or logical response."
-    )
+    # Save conversation history as two parallel lists (roles[i] goes with contents[i]) instead of one dict per message
+    roles: List[str] = []
+    contents: List[str] = []
 
 class ChatbotFlow(Flow[MessageState]): # Replaced StateGraph with CrewAI Flow class. This Flow receive MessageState class as structure State
-    # Used `@start()`, `@router()`, and `@listen()` instead of graph nodes and edges
-    @start()
-    def classify_message(self):
-        # Get user input from state
-        if not self.state.user_message:
-            return "exit"
-        
-        # Used CrewAI's `LLM` class with structured output via `response_format`
-        classifier_llm = LLM(
-            model=GEMINI_MODEL,
-            response_format=MessageClassifier
-        )
-        
-        result = classifier_llm.call([
+    # Used `@start()` and `@listen()` instead of graph nodes and edges
+    # Classification and response happen in one LLM call, so there is no `@router()` step to dispatch between personas
+    # Request prefix (system block + history dicts) per system prompt - Flow is a Pydantic model, so it is a private attribute
+    _prefix_cache: Dict[str, list] = PrivateAttr(default_factory=dict)
+
+    def summarize_history_async(self):
+        # Only runs when the threshold trips, so the extra summary call is amortized over many turns
+        # Returns the pending summary and how many messages it covers, or None below the threshold
+        if len(self.state.roles) <= SUMMARY_THRESHOLD:
+            return None
+
+        summarized = len(self.state.roles) - MAX_HISTORY_TURNS
+        future = summary_executor.submit(summary_llm.call, [
             {
                 "role": "system",
-                "content": """Classify the user message as either:
-                - 'emotional': if it asks for emotional support, therapy, deals with feelings, or personal problems
-                - 'logical': if it asks for facts, information, logical analysis, or practical solutions
-                """
+                "content": "Summarize this dialogue in 150 tokens or fewer. Keep the facts, feelings and open questions needed to continue the conversation."
             },
-            {"role": "user", "content": self.state.user_message}
+            {"role": "user", "content": "\n".join(
+                f"{role}: {content}"
+                for role, content in zip(self.state.roles[:summarized], self.state.contents[:summarized])
+            )}
         ])
-        
+        return future, summarized
+
+    def apply_history_summary(self, pending_summary):
+        # Replace the summarized messages, the turns added since the summary started are kept as they are
+        future, summarized = pending_summary
         try:
-            # LLM response could be a dict or a string, hence the parsing will handle both case
-            data = result if isinstance(result, dict) else json.loads(result)
-            parsed = MessageClassifier(**data)
-            self.state.message_type = parsed.message_type
-        except (json.JSONDecodeError, ValidationError, TypeError):
-            # fallback: default to "logical"
-            self.state.message_type = "logical"
+            summary = future.result()
+        except Exception:
+            # The summary is only an optimization - A failed call (rate limit, timeout) keeps the full history for now,
+            # the next turn is still above the threshold and retries it
+            return
+        self.state.roles = ["system"] + self.state.roles[summarized:]
+        self.state.contents = [f"Prior context summary: {summary}"] + self.state.contents[summarized:]
+        # The cached prefixes still hold the summarized messages, they are rebuilt on next use
+        self._prefix_cache.clear()
 
-        return self.state.message_type # which could be "emotional", "logical", or "exit"
+    def prefix_messages(self, system_prompt):
+        # Everything before the new user message - Shared by the reply call and the prefix warm-up
+        # Cached per system prompt and grown in place by record_turn(), so a turn does not rebuild the whole request
+        messages = self._prefix_cache.get(system_prompt)
+        if messages is not None:
+            return messages
 
+        # System prompt as a plain string - CrewAI's native Gemini provider sends it as the `system_instruction`.
+        # The prompt constants are byte-identical every turn, so Gemini's implicit prefix caching picks the prefix up on its own
+        messages = [{"role": "system", "content": system_prompt}]
 
-    @router(classify_message)
-    def route_message(self, message_type): # message_type is just a variable name for the return value of classify_message function passed by @router
-        if message_type == "exit":
-            return "exit"
-        elif message_type == "emotional":
-            return "therapist"
-        else:
-            return "logical"
-
-    @listen("therapist")
-    def therapist_response(self):
-        messages = [
-            {
-                "role": "system",
-                "content": """You are a compassionate therapist. Focus on the emotional aspects of the user's message.
-                Show empathy, validate their feelings, and help them process their emotions.
-                Ask thoughtful questions to help them explore their feelings more deeply.
-                Avoid giving logical solutions unless explicitly asked."""
-            }
-        ]
+        # Materialize the (role, content) dicts from the parallel history lists only when building a prefix
+        messages.extend([
+            {"role": role, "content": content}
+            for role, content in zip(self.state.roles, self.state.contents)
+        ])
+        self._prefix_cache[system_prompt] = messages
+        return messages
 
-        # Using .extend to add a list of dict (role, content) from conversation history to current message
-        messages.extend(self.state.conversation_history)
+    def record_turn(self, reply):
+        # Update conversation history - Extending each list by a tuple is one resize instead of two appends
+        self.state.roles += ("user", "assistant")
+        self.state.contents += (self.state.user_message, reply)
 
-        # Using .append to add a dict (role, content) from user message to current message
-        messages.append({
-            "role": "user",
-            "content": self.state.user_message
-        })
-        
-        reply = gemini_llm.call(messages)
+        # Every cached prefix gets the same two dicts, so the others stay in sync with the history
+        turn = ({"role": "user", "content": self.state.user_message}, {"role": "assistant", "content": reply})
+        for messages in self._prefix_cache.values():
+            messages += turn
 
-        # Update conversation history
-        self.state.conversation_history.extend([
-            {"role": "user", "content": self.state.user_message},
-            {"role": "assistant", "content": reply}
-        ])
+    @start()
+    def unified_response(self):
+        # Get user input from state
+        if not self.state.user_message:
+            self.state.message_type = "exit"
+            return "exit"
 
-        self.state.response = reply
-        print(f"Assistant: {reply}")
-        return reply
+        # Summarize older turns in the background when the threshold trips, this turn still sends the full history
+        pending_summary = self.summarize_history_async()
 
-    @listen("logical")
-    def logical_response(self):
-        messages = [
-            {
-                "role": "system",
-                "content": """You are a purely logical assistant. Focus only on facts and information.
-                Provide clear, concise answers based on logic and evidence.
-                Do not address emotions or provide emotional support.
-                Be direct and straightforward in your responses."""
-            }
-        ]
-        
-        # Add conversation history
-        messages.extend(self.state.conversation_history)
+        # Try the local keyword classifier first, then verdicts cached from earlier routed calls, then the ONNX model if loaded
+        # Only new ambiguous messages need the LLM to pick the persona
+        message_type = None if FORCE_LLM_ROUTING else (
+            classify_message(self.state.user_message)
+            or cached_verdict(self.state.user_message)
+            or onnx_classify(self.state.user_message)
+        )
+
+        # Persona prompt by dict lookup, the routed prompt covers messages the classifier left undecided
+        system_prompt = PERSONAS.get(message_type, ROUTED_SYS)
 
-        # Add current user message
+        messages = self.prefix_messages(system_prompt)
+
+        # Using .append to add a dict (role, content) from user message to the cached prefix for this call only,
+        # it is taken off again afterwards and record_turn() adds the finished turn to every prefix
         messages.append({
             "role": "user",
             "content": self.state.user_message
         })
-        
-        reply = gemini_llm.call(messages)
 
-        # Update conversation history
-        self.state.conversation_history.extend([
-            {"role": "user", "content": self.state.user_message},
-            {"role": "assistant", "content": reply}
-        ])
+        try:
+            if message_type:
+                # Persona is already known, stream the plain reply. `.call()` still returns the full text once the stream ends
+                print("Assistant: ", end="", flush=True)
+                reply = PERSONA_LLMS[message_type].call(messages)
+                # Wait until every chunk handler has run, so the closing newline comes after the last chunk
+                crewai_event_bus.flush()
+                print()
+            else:
+                message_type, reply = parse_routed_reply(routed_llm.call(messages))
+                if message_type:
+                    remember_verdict(self.state.user_message, message_type)
+                else:
+                    # fallback: default to "logical" and keep the raw text as the reply
+                    message_type = "logical"
+
+                # The persona tag has to be stripped first, so the routed reply is shown once it is complete
+                print(f"Assistant: {reply or '(no reply, please try again)'}")
+        finally:
+            messages.pop()
+
+        # An empty reply is not recorded, so the history holds no empty assistant turn
+        if reply:
+            self.record_turn(reply)
 
+        # Fold the finished summary in once this turn is recorded
+        if pending_summary:
+            self.apply_history_summary(pending_summary)
+
+        self.state.message_type = message_type
         self.state.response = reply
-        print(f"Assistant: {reply}")
         return reply
 
-    @listen("exit")
+    @listen(unified_response)
     def handle_exit(self):
+        # Only acts on the exit sentinel, a normal turn has already printed its reply
+        if self.state.message_type != "exit":
+            return self.state.response
         print("Bye")
         return "goodbye"
 
-def run_chatbot():
+async def warm_prefix(flow):
+    # Resend the current prefix with max_output_tokens=1 while the user is typing, so the provider keeps its KV cache for it resident.
+    # The next turn most likely uses the same persona as the last one, so that prompt is warmed.
+    # Once sent, the request runs to completion in its thread - Cancelling the task would only stop waiting for it
+    system_prompt = PERSONAS.get(flow.state.message_type, ROUTED_SYS)
+    prefix_chars = len(system_prompt) + sum(len(content) for content in flow.state.contents)
+    if prefix_chars // 4 < IMPLICIT_CACHE_MIN_TOKENS:
+        return
+    # Copy the cached prefix, the request runs in a thread and must not see the next turn's appends
+    messages = flow.prefix_messages(system_prompt) + [{"role": "user", "content": "."}]
+    try:
+        await asyncio.to_thread(warm_llm.call, messages)
+    except Exception:
+        # Warm-up is best effort, a failure here must not interrupt the chat
+        pass
+
+async def run_chatbot():
     flow = ChatbotFlow()
+    last_input = None
+    warm_tasks = set() # The event loop only keeps weak references to tasks, running warm-ups are held here until done
     while True:
-        user_input = input("Type your message here or type exit to quit: ")
-        if user_input.lower().strip() == "exit":
+        user_input = await ainput("Type your message here or type exit to quit: ")
+
+        message = user_input.strip()
+        if message.lower() == "exit":
             break
 
-        flow.state.user_message = user_input
-        result = flow.kickoff()
+        # Guard at the REPL boundary - Accidental Enter presses and one-character inputs never reach the LLM
+        if len(message) < 2:
+            print("(please say more)")
+            continue
+        # Same message as last turn, show the same reply again instead of another round trip
+        if message == last_input:
+            print(f"Assistant: {flow.state.response}")
+            continue
+
+        flow.state.user_message = message
+        # `kickoff()` starts its own event loop, inside a running loop the async variant is used instead.
+        # The listener graph itself is built once in `ChatbotFlow()` and is not rebuilt per turn.
+        result = await flow.kickoff_async()
+        # Only an answered message counts for the repeat check
+        last_input = message if flow.state.response else None
         
         # Check if user wants to exit
         if flow.state.message_type == "exit" or result == "goodbye":
             break
 
+        # Warm the cache once per completed turn - Guarded or repeated inputs leave the prefix unchanged and send nothing
+        warm_task = asyncio.create_task(warm_prefix(flow))
+        warm_tasks.add(warm_task)
+        warm_task.add_done_callback(warm_tasks.discard)
+
 if __name__ == "__main__":
-    run_chatbot()
\ No newline at end of file
+    asyncio.run(run_chatbot())
@@ -1,9 +1,11 @@
-from crewai.flow.flow import Flow, listen, router, start, or_
+from crewai.flow.flow import Flow, listen, start
 from crewai import LLM, Agent, Task, Crew
-from pydantic import BaseModel, Field, ValidationError
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 from dotenv import load_dotenv
-from typing import Literal, List, Dict
-import os, json
+from google.genai import types as genai_types
+from typing import Literal, List
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, atexit, httpx, os, orjson
 
 # Load environment variables - Same as langgraph
 load_dotenv()
@@ -11,185 +13,210 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 GEMINI_MODEL = os.environ.get("MODEL")
 os.environ["CREWAI_DISABLE_TELEMETRY"] = "True" # Disable telemetry error message in terminal
 
+# One pooled HTTP/2 client for every Gemini call in the process - Keep-alive connections are reused across turns
+# instead of paying a new TCP + TLS handshake per request. CrewAI's Gemini provider hands it to the google-genai client.
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+    timeout=60
+)
+atexit.register(http_client.close)
+GEMINI_CLIENT_PARAMS = {"http_options": genai_types.HttpOptions(httpx_client=http_client)}
+
 # Define LLM model - Used CrewAI's `LLM` class
+# Chat replies are short and the agent may answer in either persona, so it gets the same 512-token reply budget as the
+# direct-call routed handle, plus room for the agent's "Final Answer:" wrapper and the RoutedReply JSON keys.
+# CrewAI's native Gemini provider only sends `max_output_tokens`, a `max_tokens` would be stored but never applied
 gemini_llm = LLM(
     model=GEMINI_MODEL,
     temperature=0,
-    max_tokens=4096
+    max_output_tokens=640,
+    client_params=GEMINI_CLIENT_PARAMS
+)
+
+# Rolling history window - Once the history grows past SUMMARY_THRESHOLD messages,
+# everything but the last MAX_HISTORY_TURNS messages is folded into a short summary
+MAX_HISTORY_TURNS = 8
+SUMMARY_THRESHOLD = 16
+
+# One background worker for the summary call, so it overlaps with the reply instead of delaying it
+summary_executor = ThreadPoolExecutor(max_workers=1)
+
+# Define the agent once at import and reuse it every turn - Only the task changes between turns
+unified_agent = Agent(
+    role="Adaptive Assistant",
+    goal="Decide whether the user needs emotional support or a logical answer, then respond in that persona",
+    backstory="""You switch between two personas depending on the user's message.
+        As a compassionate therapist you focus on the emotional aspects of the user's message.
+        You show empathy, validate their feelings, and ask thoughtful questions to help them explore their feelings more deeply.
+        As a purely logical assistant you focus only on facts and information.
+        You provide clear, concise answers based on logic and evidence, and do not address emotions.""",
+    llm=gemini_llm
 )
 
 # Define the state model - Used Pydantic `BaseModel` for structured state instead of TypedDict
-# Langgraph's add_message automatically append conversation history. 
+# Langgraph's add_messages reducer can automatically append conversation history. 
 # CrewAI can even maintain conversation history between sessions by @persist decorator
 # In this example, to maintain coversation history within session, need to do it manually
 class MessageState(BaseModel):
+    # Internal value holder, not a validation boundary - Assignments such as `self.state.response = ...` are stored without
+    # re-running the field validators. CrewAI's Flow only accepts a BaseModel or dict state, so a slots dataclass is not an option
+    model_config = ConfigDict(validate_assignment=False)
+
     user_message: str = ""
     message_type: str = ""
     response: str = ""
-    conversation_history: List[Dict[str, str]] = [] # Save conversation history
+    # Save conversation history as two parallel lists (roles[i] goes with contents[i]) instead of one dict per message
+    roles: List[str] = []
+    contents: List[str] = []
 
-# Define the classifier model - Same as langgraph
-class MessageClassifier(BaseModel):
+# Define the routed reply model - The agent picks the persona and writes the reply in the same task
+class RoutedReply(BaseModel):
     message_type: Literal["emotional", "logical"] = Field(
         ...,
         description="Classify if the message requires an emotional (therapist) or logical response."
     )
+    reply: str = Field(
+        ...,
+        description="The response to the user, written in the persona chosen by message_type."
+    )
 
 class ChatbotFlow(Flow[MessageState]): # Replaced StateGraph with CrewAI Flow class. This Flow receive MessageState class as structure State
-    # Used `@start()`, `@router()`, and `@listen()` instead of graph nodes and edges
-    @start()
-    def classify_message(self):
-        # Get user input from state
-        if not self.state.user_message:
-            return "exit"
-        
-        # Used CrewAI's `LLM` class with structured output via `response_format`
-        classifier_llm = LLM(
-            model=GEMINI_MODEL,
-            response_format=MessageClassifier
-        )
-        
-        result = classifier_llm.call([
+    # Used `@start()` and `@listen()` instead of graph nodes and edges
+    # Classification and response happen in one crew run, so there is no `@router()` step to dispatch between personas
+    def summarize_history_async(self):
+        # Only runs when the threshold trips, so the extra summary call is amortized over many turns
+        # Returns the pending summary and how many messages it covers, or None below the threshold
+        if len(self.state.roles) <= SUMMARY_THRESHOLD:
+            return None
+
+        summarized = len(self.state.roles) - MAX_HISTORY_TURNS
+        future = summary_executor.submit(gemini_llm.call, [
             {
                 "role": "system",
-                "content": """Classify the user message as either:
-                - 'emotional': if it asks for emotional support, therapy, deals with feelings, or personal problems
-                - 'logical': if it asks for facts, information, logical analysis, or practical solutions
-                """
+                "content": "Summarize this dialogue in 150 tokens or fewer. Keep the facts, feelings and open questions needed to continue the conversation."
             },
-            {"role": "user", "content": self.state.user_message}
+            {"role": "user", "content": "\n".join(
+                f"{role}: {content}"
+                for role, content in zip(self.state.roles[:summarized], self.state.contents[:summarized])
+            )}
         ])
-        
-        try:
-            # LLM response could be a dict or a string, hence the parsing will handle both case
-            data = result if isinstance(result, dict) else json.loads(result)
-            parsed = MessageClassifier(**data)
-            self.state.message_type = parsed.message_type
-        except (json.JSONDecodeError, ValidationError, TypeError):
-            # fallback: default to "logical"
-            self.state.message_type = "logical"
-
-        return self.state.message_type # which could be "emotional", "logical", or "exit"
+        return future, summarized
 
+    def apply_history_summary(self, pending_summary):
+        # Replace the summarized messages, the turns added since the summary started are kept as they are
+        future, summarized = pending_summary
+        try:
+            summary = future.result()
+        except Exception:
+            # The summary is only an optimization - A failed call (rate limit, timeout) keeps the full history for now,
+            # the next turn is still above the threshold and retries it
+            return
+        self.state.roles = ["system"] + self.state.roles[summarized:]
+        self.state.contents = [f"Prior context summary: {summary}"] + self.state.contents[summarized:]
 
-    @router(classify_message)
-    def route_message(self, message_type): # message_type is just a variable name for the return value of classify_message function passed by @router
-        if message_type == "exit":
+    @start()
+    def unified_response(self):
+        # Get user input from state
+        if not self.state.user_message:
+            self.state.message_type = "exit"
             return "exit"
-        elif message_type == "emotional":
-            return "therapist"
-        else:
-            return "logical"
-
-    @listen("therapist")
-    def therapist_response(self):
-        # Convert conversation history to plain text in the task description
-        conversation_history = ""
-        if self.state.conversation_history:
-            conversation_history = "\n".join([
-                f"{msg['role']}: {msg['content']}" 
-                for msg in self.state.conversation_history
-            ])
-
-        therapist_agent = Agent(
-            role="Compassionate Therapist",
-            goal="Provide emotional support and validate feelings",
-            backstory="""You are a compassionate therapist. Focus on the emotional aspects of the user's message.
-                Show empathy, validate their feelings, and help them process their emotions.
-                Ask thoughtful questions to help them explore their feelings more deeply.
-                Avoid giving logical solutions unless explicitly asked.""",
-            llm=gemini_llm
-        )
-
-        therapist_task = Task(
-            description=f"""
-            Conversation history:
-            {conversation_history} 
-            Provide therapeutic response to: {self.state.user_message}
-            """,
-            expected_output="Empathetic response with thoughtful questions to help them explore their feelings more deeply",
-            agent=therapist_agent
-        )
-        
-        crew = Crew(agents=[therapist_agent], tasks=[therapist_task])
-        result = crew.kickoff()
-        reply = result.raw
-
-        # Update conversation history (use extend to add a list of dict into conversation history list)
-        self.state.conversation_history.extend([
-            {"role": "user", "content": self.state.user_message},
-            {"role": "assistant", "content": reply}
-        ])
 
-        self.state.response = reply
-        return reply
+        # Summarize older turns in the background when the threshold trips, this turn still renders the full history
+        pending_summary = self.summarize_history_async()
 
-    @listen("logical")
-    def logical_response(self):
         # Convert conversation history to plain text in the task description
         conversation_history = ""
-        if self.state.conversation_history:
+        if self.state.roles:
             conversation_history = "\n".join([
-                f"{msg['role']}: {msg['content']}" 
-                for msg in self.state.conversation_history[-10:]  # Last 10 messages
+                f"{role}: {content}"
+                for role, content in zip(self.state.roles, self.state.contents)
             ])
-        
-        logical_agent = Agent(
-            role="Logical Assistant",
-            goal="Provide clear, factual answers based on logic and evidence",
-            backstory="""You are a purely logical assistant. Focus only on facts and information.
-                Provide clear, concise answers based on logic and evidence.
-                Do not address emotions or provide emotional support.
-                Be direct and straightforward in your responses.""",
-            llm=gemini_llm
-        )
 
-        logical_task = Task(
+        unified_task = Task(
             description=f"""
             Conversation history:
             {conversation_history}
-            Current question: {self.state.user_message}""",
-            expected_output="A logical, fact-based response without emotional content",
-            agent=logical_agent
+            First decide silently whether the user's message is emotional or logical, then respond in that persona.
+            - 'emotional': if it asks for emotional support, therapy, deals with feelings, or personal problems
+            - 'logical': if it asks for facts, information, logical analysis, or practical solutions
+            User message: {self.state.user_message}
+            """,
+            expected_output="The message_type ('emotional' or 'logical') and the reply written in that persona",
+            agent=unified_agent,
+            output_pydantic=RoutedReply
         )
 
-        crew = Crew(agents=[logical_agent], tasks=[logical_task])
+        crew = Crew(agents=[unified_agent], tasks=[unified_task])
         result = crew.kickoff()
-        reply = result.raw
-
-        # Update conversation history (use extend to add a list of dict into conversation history list)
-        self.state.conversation_history.extend([
-            {"role": "user", "content": self.state.user_message},
-            {"role": "assistant", "content": reply}
-        ])
 
+        try:
+            # Crew output is normally already parsed into `result.pydantic`, otherwise parse the raw string
+            parsed = result.pydantic or RoutedReply(**orjson.loads(result.raw))
+            message_type, reply = parsed.message_type, parsed.reply
+        except (orjson.JSONDecodeError, ValidationError, TypeError):
+            # fallback: default to "logical" and keep the raw text as the reply
+            message_type, reply = "logical", result.raw
+
+        # Update conversation history - Extending each list by a tuple is one resize instead of two appends
+        self.state.roles += ("user", "assistant")
+        self.state.contents += (self.state.user_message, reply)
+
+        # Fold the finished summary in once this turn is recorded
+        if pending_summary:
+            self.apply_history_summary(pending_summary)
+
+        self.state.message_type = message_type
         self.state.response = reply
         return reply
     
-    @listen(or_("therapist_response", "logical_response"))
+    @listen(unified_response)
     def display_response(self, response):
-        """This listener waits for therapist or logical to finish and prints the response."""
+        """This listener waits for the unified response to finish and prints it."""
+        if self.state.message_type == "exit":
+            return response
         print(f"Assistant: {response}")
         return response
 
-    @listen("exit")
+    @listen(unified_response)
     def handle_exit(self):
+        # Only acts on the exit sentinel, display_response handles a normal turn
+        if self.state.message_type != "exit":
+            return self.state.response
         print("Bye")
         return "goodbye"
 
 def run_chatbot():
+    # The flow's listener graph is built once in `ChatbotFlow()` and cached on the class, `kickoff()` does not rebuild it.
+    # What `kickoff()` does repeat is `asyncio.run()`, a new event loop per turn, so one loop is kept for the whole session.
     flow = ChatbotFlow()
-    while True:
-        user_input = input("Type your message here or type exit to quit: ")
-        if user_input.lower().strip() == "exit":
-            break
-
-        flow.state.user_message = user_input
-        result = flow.kickoff()
-        
-        # Check if user wants to exit
-        if flow.state.message_type == "exit" or result == "goodbye":
-            break
+    loop = asyncio.new_event_loop()
+    last_input = None
+    try:
+        while True:
+            user_input = input("Type your message here or type exit to quit: ")
+            message = user_input.strip()
+            if message.lower() == "exit":
+                break
+
+            # Guard at the REPL boundary - Accidental Enter presses and one-character inputs never reach the LLM
+            if len(message) < 2:
+                print("(please say more)")
+                continue
+            # Same message as last turn, show the same reply again instead of another round trip
+            if message == last_input:
+                print(f"Assistant: {flow.state.response}")
+                continue
+
+            flow.state.user_message = message
+            result = loop.run_until_complete(flow.kickoff_async())
+            last_input = message
+
+            # Check if user wants to exit
+            if flow.state.message_type == "exit" or result == "goodbye":
+                break
+    finally:
+        loop.close()
 
 if __name__ == "__main__":
     run_chatbot()
\ No newline at end of file
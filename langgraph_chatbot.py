@@ -1,9 +1,8 @@
 from dotenv import load_dotenv
-from typing import Annotated, Literal
+import httpx, os, re
+from collections import OrderedDict
 from langgraph.graph import StateGraph, START, END
-from langgraph.graph.message import add_message
-from langchain.chat_models import ChatGoogleGenerativeAI
-from pydantic import BaseModel, Field
+from langchain_google_genai import ChatGoogleGenerativeAI
 from typing_extensions import TypedDict
 
 load_dotenv()
@@ -14,134 +13,247 @@ llm = ChatGoogleGenerativeAI(
     temperature=0,
     max_tokens=None,
     timeout=None,
-    max_retries=2
+    max_retries=2,
+    # Arguments for the underlying httpx client (langchain-google-genai >= 4.0) - It lives as long as `llm`,
+    # so HTTP/2 keep-alive connections are reused across turns
+    client_args={
+        "http2": True,
+        "limits": httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300)
+    }
 )
 
-# Define the message structure by state
-# Literal constrains a value to a fixed set of string(s)
-class MessageClassifier(BaseModel):
-    """A schema that return message_type and that it must be either "emotional" or "logical"."""
-    message_type: Literal["emotional", "logical"] = Field(
-        ..., 
-        description="Classify if the message requires an emotional (therapist) or logical response."
-    )
+# Per-persona decode budgets - `.bind()` reuses the same client, chat replies are short so tight
+# `max_output_tokens` and stop sequences end runaway generations early
+therapist_llm = llm.bind(temperature=0.3, max_output_tokens=512)
+logical_llm = llm.bind(max_output_tokens=384, stop=["\n\nUser:", "\n\n---"])
+routed_llm = llm.bind(max_output_tokens=512, stop=["\n\nUser:"]) # May answer in either persona, so it gets the larger budget
+PERSONA_LLMS = {"emotional": therapist_llm, "logical": logical_llm}
+
+# System prompts - Module-level constants so every turn sends a byte-identical prefix, which is what provider-side prefix caching matches on
+THERAPIST_SYS = """You are a compassionate therapist. Focus on the emotional aspects of the user's message.
+Show empathy, validate their feelings, and help them process their emotions.
+Ask thoughtful questions to help them explore their feelings more deeply.
+Avoid giving logical solutions unless explicitly asked."""
+
+LOGICAL_SYS = """You are a purely logical assistant. Focus only on facts and information.
+Provide clear, concise answers based on logic and evidence.
+Do not address emotions or provide emotional support.
+Be direct and straightforward in your responses."""
+
+# Persona table - message_type -> system prompt, so both personas share one response path
+PERSONAS = {"emotional": THERAPIST_SYS, "logical": LOGICAL_SYS}
+
+ROUTED_SYS = """First decide silently whether the user's message is emotional or logical, then respond in that persona.
+- 'emotional': if it asks for emotional support, therapy, deals with feelings, or personal problems.
+  Respond as a compassionate therapist. Show empathy, validate their feelings, and help them process their emotions.
+  Ask thoughtful questions to help them explore their feelings more deeply.
+  Avoid giving logical solutions unless explicitly asked.
+- 'logical': if it asks for facts, information, logical analysis, or practical solutions.
+  Respond as a purely logical assistant. Provide clear, concise answers based on logic and evidence.
+  Do not address emotions or provide emotional support. Be direct and straightforward.
+Begin your response with a single character on its own line: E for emotional or L for logical. Then write the reply."""
+
+# Precompiled keyword scorers for the local classifier - Clear-cut messages are classified without an LLM call
+EMO = re.compile(r"\b(feel|sad|anxious|lonely|depress|angry|hurt|cry|grief|stressed|overwhelm|scared|love|hate)\w*\b", re.I)
+LOG = re.compile(r"\b(what is|what are|how do|how does|how to|why does|calculate|define|explain|compare|\d+)\b", re.I)
+
+def classify_message(text: str) -> str | None:
+    """Score the text with the keyword regexes and return "emotional" or "logical" when they clearly disagree, None when the LLM should decide."""
+    emo_hits = len(EMO.findall(text))
+    log_hits = len(LOG.findall(text))
+    if abs(emo_hits - log_hits) >= 2 or (min(emo_hits, log_hits) == 0 and max(emo_hits, log_hits) >= 1):
+        return "emotional" if emo_hits > log_hits else "logical"
+    return None
+
+# Persona tags for the routed call - The model spends one leading character on the classification instead of a JSON object
+PERSONA_TAGS = {"E": "emotional", "L": "logical"}
+LEADING_BLANK_LINES = re.compile(r"^(?:[ \t]*\n)+")
+
+def parse_routed_reply(text: str) -> tuple[str | None, str]:
+    """Split "E\n<reply>" / "L\n<reply>" into (message_type, reply).
+    message_type is None when the model left out the tag or wrote nothing after it (e.g. a stop or length cutoff)."""
+    text = text.lstrip()
+    tag = text[:1].upper()
+    rest = text[1:].lstrip(" ")
+    # Only a tag followed by a newline or ':' counts, so replies such as "E.g., ..." are not mistaken for a tag.
+    # The separator and any blank lines after it are removed, the reply's own leading characters (e.g. a "- " bullet) are kept
+    if tag in PERSONA_TAGS and (not rest or rest[0] in "\n:"):
+        reply = LEADING_BLANK_LINES.sub("", rest.removeprefix(":").lstrip(" "))
+        # A bare tag is no verdict, so it is never cached
+        return (PERSONA_TAGS[tag], reply) if reply.strip() else (None, "")
+    return None, text
+
+# Verdicts of earlier routed calls by normalized message - Repeats such as "thanks" or "what?" skip the routed prompt
+# The cache lives for the process, which only ever talks to the model configured at import
+VERDICT_CACHE_SIZE = 1024
+verdict_cache: OrderedDict[str, str] = OrderedDict()
+
+def normalize_message(text: str) -> str:
+    """Lowercase and collapse whitespace, so trivially different spellings share a cache entry."""
+    return " ".join(text.lower().split())
+
+def cached_verdict(text: str) -> str | None:
+    """Return the cached persona for the text, moving it to the most recently used end."""
+    key = normalize_message(text)
+    if key not in verdict_cache:
+        return None
+    verdict_cache.move_to_end(key)
+    return verdict_cache[key]
+
+def remember_verdict(text: str, message_type: str) -> None:
+    """Store the persona picked by the routed call, evicting the least recently used entry when full."""
+    key = normalize_message(text)
+    verdict_cache[key] = message_type
+    verdict_cache.move_to_end(key)
+    if len(verdict_cache) > VERDICT_CACHE_SIZE:
+        verdict_cache.popitem(last=False)
+
+# Optional local classifier - A distilled 2-class transformer exported to ONNX and quantized to int8, a few ms on CPU
+# It is only loaded when CLASSIFIER_ONNX / CLASSIFIER_TOKENIZER point at existing files and onnxruntime + tokenizers are installed,
+# otherwise undecided messages go to the routed LLM call as before. The model file is not shipped with this repo.
+# Expected model: inputs `input_ids` and `attention_mask` (int64), output logits of shape (1, 2) with index 0 = emotional, 1 = logical
+# Both paths default to files next to this script, not to the current working directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CLASSIFIER_ONNX = os.environ.get("CLASSIFIER_ONNX", os.path.join(SCRIPT_DIR, "classifier_int8.onnx"))
+CLASSIFIER_TOKENIZER = os.environ.get("CLASSIFIER_TOKENIZER", os.path.join(SCRIPT_DIR, "classifier_tokenizer.json"))
+# Debug/eval switch - Skips every local classifier so each message goes through the routed LLM call
+FORCE_LLM_ROUTING = os.environ.get("FORCE_LLM_ROUTING", "").lower() in ("1", "true")
+
+classifier_session = None
+classifier_tokenizer = None
+if not FORCE_LLM_ROUTING and os.path.exists(CLASSIFIER_ONNX) and os.path.exists(CLASSIFIER_TOKENIZER):
+    try:
+        import numpy as np
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+        # Loaded once at import, every turn reuses the same session
+        classifier_session = ort.InferenceSession(CLASSIFIER_ONNX, providers=["CPUExecutionProvider"])
+        classifier_tokenizer = Tokenizer.from_file(CLASSIFIER_TOKENIZER)
+        classifier_tokenizer.enable_truncation(max_length=128)
+    except Exception as e:
+        # Missing packages or a corrupt / incompatible model file must not stop the chatbot from starting
+        print(f"(local classifier disabled: {e})")
+        classifier_session = None
+        classifier_tokenizer = None
+
+def onnx_classify(text: str) -> str | None:
+    """Classify the text with the local ONNX model, None when the model is not loaded."""
+    if classifier_session is None:
+        return None
+    encoding = classifier_tokenizer.encode(text)
+    ids = np.array([encoding.ids], dtype=np.int64)
+    mask = np.array([encoding.attention_mask], dtype=np.int64)
+    try:
+        logits = classifier_session.run(None, {"input_ids": ids, "attention_mask": mask})[0]
+    except Exception:
+        # A model whose inputs or outputs do not match leaves the message to the routed LLM call
+        return None
+    return "emotional" if logits[0, 0] > logits[0, 1] else "logical"
 
 # Defines the shape of the graph State as a dictionary type.
 class State(TypedDict):
-    # Annotated attaches metadata (used later with add_messages)
-    # add_messages: a reducer/merge function LangGraph provides for handling how the messages field should be combined across node outputs 
-    # Annotated[list, add_messages] tells StateGraph how to combine multiple partial results for messages 
-    # (e.g., append assistant reply to the message list).
-    messages: Annotated[list, add_message] 
+    # Annotated[list, add_messages] would attach LangGraph's add_messages reducer, which merges every node output into the list
+    # and converts each dict into a message object. This graph has a single node that appends one reply per turn,
+    # so a plain list is used: the node returns the full new list and LangGraph simply stores it, no reducer pass.
+    messages: list
     message_type: str | None
 
-# Define functions of each node
-def classify_message(state: State) -> State:
-    """Look at the last user message and classify it as "emotional" or "logical"."""
+# Define the function of the node
+def unified_response(state: State) -> State:
+    """Look at the last user message, classify it as "emotional" or "logical" and answer it in that persona.
+    The keyword classifier, the verdict cache or the local ONNX model settle known messages, otherwise a single routed LLM call picks the persona and answers."""
     last_message = state["messages"][-1]
-    classifier_llm = llm.with_structured_output(MessageClassifier) # wraps the LLM so its output is parsed into the MessageClassifier Pydantic model.
-
-    result = classifier_llm.invoke([
-        {
-            "role": "system",
-            "content": """Classify the user message as either:
-            - 'emotional': if it asks for emotional support, therapy, deals with feelings, or personal problems
-            - 'logical': if it asks for facts, information, logical analysis, or practical solutions
-            """
-        },
-        {"role": "user", "content": last_message}
-    ])
-    return {"message_type": result.message_type} # returns a partial state update. LangGraph will merge this into the running state.
-
-def router(state: State) -> State:
-    """Read the message_type and return a State (graph's conditional edges) use to route flow to the appropriate agent node."""
-    message_type = state.get("message_type", "logical") # Default to logical if not be able to classify
-    if message_type == "emotional":
-        return {"next": "therapist"}
-    else:
-        return {"next": "logical"}
+    message_type = None if FORCE_LLM_ROUTING else (
+        classify_message(last_message["content"])
+        or cached_verdict(last_message["content"])
+        or onnx_classify(last_message["content"])
+    )
+
+    # Persona prompt by dict lookup, the routed prompt covers messages the classifier left undecided
+    system_prompt = PERSONAS.get(message_type, ROUTED_SYS)
 
-def therapist_agent(state: State) -> State:
-    """Get the last message (from user), pass to therapist agent and return the assistant response"""
-    last_message = state["messages"][-1]
     messages = [
-        {"role": "system",
-         "content": """You are a compassionate therapist. Focus on the emotional aspects of the user's message.
-                        Show empathy, validate their feelings, and help them process their emotions.
-                        Ask thoughtful questions to help them explore their feelings more deeply.
-                        Avoid giving logical solutions unless explicitly asked."""},
-         {"role": "user",
-          "content": last_message.content}
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": last_message["content"]}
     ]
-    reply = llm.invoke(messages)
 
-    # Returns a partial state containing one assistant message — the add_messages reducer will append this to the conversation.
-    return {"messages": [{"role": "assistant", "content": reply.content}]}
+    if message_type:
+        # Persona is already known, stream the plain reply and print chunks as they arrive
+        print("Assistant: ", end="", flush=True)
+        chunks = []
+        for chunk in PERSONA_LLMS[message_type].stream(messages):
+            print(chunk.content, end="", flush=True)
+            chunks.append(chunk.content)
+        print()
+        reply = "".join(chunks)
+    else:
+        # The persona tag has to be stripped first, so the routed reply is shown once it is complete
+        message_type, reply = parse_routed_reply(routed_llm.invoke(messages).content)
+        if message_type:
+            remember_verdict(last_message["content"], message_type)
+        else:
+            message_type = "logical" # Default to logical if the model left out the persona tag
+        print(f"Assistant: {reply or '(no reply, please try again)'}")
 
-def logical_agent(state: State) -> State:
-    """Get the last message (from user), pass to logical agent and return the assistant response"""
-    last_message = state["messages"][-1]
-    messages = [
-        {"role": "system",
-         "content": """You are a purely logical assistant. Focus only on facts and information.
-            Provide clear, concise answers based on logic and evidence.
-            Do not address emotions or provide emotional support.
-            Be direct and straightforward in your responses."""},
-         {"role": "user",
-          "content": last_message.content}
-    ]
-    reply = llm.invoke(messages)
-    return {"messages": [{"role": "assistant", "content": reply.content}]}
+    if not reply:
+        # Nothing to keep - Drop the unanswered user message as well, so the history holds no empty assistant turn
+        return {"message_type": message_type, "messages": state["messages"][:-1]}
+
+    # Returns a partial state containing the persona and the conversation with the assistant reply appended — without a reducer, LangGraph stores the list as is.
+    return {
+        "message_type": message_type,
+        "messages": state["messages"] + [{"role": "assistant", "content": reply}]
+    }
 
 # Define the graph builder
 graph_builder = StateGraph(State)
 
-# Define all the nodes in the graph
+# Define the node in the graph
 # A Node is a step in your workflow to performs an action or function using the current state.
 # First parameter is node name, second is function that will run when the node is executed
-graph_builder.add_node("classifier", classify_message)
-graph_builder.add_node("router", router)
-graph_builder.add_node("therapist", therapist_agent)
-graph_builder.add_node("logical", logical_agent)
+# Classification and response share one node, so no router or conditional edges are needed
+graph_builder.add_node("classifier", unified_response)
 
 # Define all the edges in the graph
 # It is the connection between nodes, defines the flow of execution from one node to another.
 graph_builder.add_edge(START, "classifier")
-graph_builder.add_edge("classifier", "router")
-
-graph_builder.add_conditional_edges(
-    "router",
-    lambda state: state.get("next"),
-    {"therapist": "therapist", "logical": "logical"}
-)
 
 # Wrap it up and complie the graph
-graph_builder.add_edge("therapist", END)
-graph_builder.add_edge("logical", END)
+graph_builder.add_edge("classifier", END)
 graph = graph_builder.compile()
 
 # Chatbot function
 def run_chatbot():
     """Chatbot to get user query and return AI response"""
     state = {"messages": [], "message_type": None} # Initialize state with an empty conversation.
+    last_input = None
 
     while True:
         user_input = input("Enter your message: ")
-        if user_input.strip().lower() == "exit":
+        message = user_input.strip()
+        if message.lower() == "exit":
             print("Bye")
             break
 
-        # Append the new user message to the messages list.
-        # It is necessary when you are building the initial state before it enters the graph.
-        # After that, add_messages will automatically merge them together inside the graph
-        state["messages"] = state.get("messages", []) + [{"role": "user", "content": user_input}] 
+        # Guard before `graph.invoke()` - Accidental Enter presses and one-character inputs never reach the LLM
+        if len(message) < 2:
+            print("(please say more)")
+            continue
+        # Same message as last turn, show the last assistant reply again instead of another round trip
+        if message == last_input:
+            print(f"Assistant: {state['messages'][-1]['content']}")
+            continue
 
-        # Runs the graph (classifier → router → chosen agent), and LangGraph merges the returned partial state updates into a new current state.
-        state = graph.invoke(state)
+        # Append the new user message to the messages list before it enters the graph.
+        # The node appends the assistant reply the same way, messages stay plain dicts.
+        state["messages"] = state.get("messages", []) + [{"role": "user", "content": message}] 
+        sent = len(state["messages"])
 
-        if state.get("messages") and len(state["messages"]) > 0:
-            last_message = state["messages"][-1]
-            print(f"Assistant: {last_message.content}")
+        # Runs the graph (classifier answers in the chosen persona), and LangGraph merges the returned partial state updates into a new current state.
+        # The reply is printed inside the node while it streams, so nothing is printed here.
+        state = graph.invoke(state)
+        # Only an answered message counts for the repeat check, an empty reply was dropped from the history
+        last_input = message if len(state["messages"]) > sent else None
 
 if __name__ == "__main__":
     run_chatbot()
\ No newline at end of file